@@ -0,0 +1,92 @@
+##################################################################################################
+# E-Stop USB boot configuration by Kenneth Lopez
+#
+# Runs once at power up, before USB is connected. Replaces CircuitPython's default HID devices
+#	(keyboard, mouse, consumer control) with a single boot protocol keyboard
+#	The E-Stop only ever sends one key, so the mouse and consumer control devices are dead
+#	weight. Without them the keyboard has the HID endpoint to itself and needs no report ID
+#
+# Changes to this file only take effect after a hard reset (unplug or press reset)
+#
+# Note: The HID endpoint polling interval (bInterval) is fixed by the CircuitPython build and
+#	can't be requested from here
+#
+#
+#    Copyright (C) 2024  Kenneth Lopez (lopezk38@gmail.com)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+##################################################################################################
+
+import usb_hid
+
+
+##################################################################################################
+# Boot keyboard descriptor
+##################################################################################################
+
+#Standard boot protocol keyboard report descriptor (HID 1.11 spec, appendix B.1)
+#No report ID, 8 byte input report (modifiers, reserved, 6 keys), 1 byte output report (LEDs)
+KEYBOARD_REPORT_DESCRIPTOR = bytes((
+    0x05, 0x01, #Usage Page (Generic Desktop)
+    0x09, 0x06, #Usage (Keyboard)
+    0xA1, 0x01, #Collection (Application)
+    0x05, 0x07, #  Usage Page (Keyboard/Keypad)
+    0x19, 0xE0, #  Usage Minimum (Left Control)
+    0x29, 0xE7, #  Usage Maximum (Right GUI)
+    0x15, 0x00, #  Logical Minimum (0)
+    0x25, 0x01, #  Logical Maximum (1)
+    0x75, 0x01, #  Report Size (1)
+    0x95, 0x08, #  Report Count (8)
+    0x81, 0x02, #  Input (Data, Variable, Absolute) - Modifier byte
+    0x95, 0x01, #  Report Count (1)
+    0x75, 0x08, #  Report Size (8)
+    0x81, 0x01, #  Input (Constant) - Reserved byte
+    0x95, 0x05, #  Report Count (5)
+    0x75, 0x01, #  Report Size (1)
+    0x05, 0x08, #  Usage Page (LEDs)
+    0x19, 0x01, #  Usage Minimum (Num Lock)
+    0x29, 0x05, #  Usage Maximum (Kana)
+    0x91, 0x02, #  Output (Data, Variable, Absolute) - LED report
+    0x95, 0x01, #  Report Count (1)
+    0x75, 0x03, #  Report Size (3)
+    0x91, 0x01, #  Output (Constant) - LED report padding
+    0x95, 0x06, #  Report Count (6)
+    0x75, 0x08, #  Report Size (8)
+    0x15, 0x00, #  Logical Minimum (0)
+    0x25, 0x65, #  Logical Maximum (101)
+    0x05, 0x07, #  Usage Page (Keyboard/Keypad)
+    0x19, 0x00, #  Usage Minimum (0)
+    0x29, 0x65, #  Usage Maximum (101)
+    0x81, 0x00, #  Input (Data, Array) - Key array (6 keys)
+    0xC0,       #End Collection
+))
+
+
+##################################################################################################
+# USB setup
+##################################################################################################
+
+keyboard = usb_hid.Device(
+    report_descriptor=KEYBOARD_REPORT_DESCRIPTOR,
+    usage_page=0x01, #Generic Desktop
+    usage=0x06, #Keyboard
+    report_ids=(0,), #No report ID, required for a boot keyboard
+    in_report_lengths=(8,),
+    out_report_lengths=(1,),
+)
+
+usb_hid.set_interface_name("E-Stop USB")
+usb_hid.enable((keyboard,), boot_device=1) #1 == boot keyboard
@@ -33,14 +33,21 @@
 # Imports
 ##################################################################################################
 
-import time
+import micropython
+from micropython import const
 
 import board
 import digitalio
+import keypad
+import rp2pio
+
+import adafruit_pioasm
+
+import asyncio
+from adafruit_ticks import ticks_ms, ticks_add, ticks_diff
 
 import usb_hid
 from adafruit_hid.keyboard import Keyboard
-from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
 from adafruit_hid.keycode import Keycode
 
 
@@ -62,74 +69,90 @@ FLASHING_LEDS_ONLY = False
 #The key to send while the E-Stop is triggered
 KEYCODE = Keycode.ESCAPE
 
+#Times are whole milliseconds wrapped in const() so the compiler folds them into the bytecode
+
 #How long to wait in between keypresses while the E-Stop is triggered
-DELAY = 5 #seconds
+DELAY = const(5000) #milliseconds
 
 #How long to hold the key down for during a keypress
 #Must be less than DELAY or program behavior will be undefined
-DWELL = 0.25 #seconds
+DWELL = const(250) #milliseconds
 
 #How long to hold the ready LED on or off for while flashing
-FLASHTIME = 0.25 #seconds. This is equal to 1/2 the frequency period, so 0.5 seconds == 1 Hz
+#Must be between 1 and 17000 milliseconds, the range the ready LED blinker can time
+FLASHTIME = const(250) #milliseconds. This is equal to 1/2 the frequency period, so 500 ms == 1 Hz
+
+#How often the inputs are scanned. Debounces them, so it must be longer than the switches bounce
+DEBOUNCE = const(10) #milliseconds
 
 
 ##################################################################################################
 # Pin definitions
 ##################################################################################################
 
-class Pins():
-    #Set pin objects to simple names
-    ESTOP = digitalio.DigitalInOut(board.RX)
-    KEYCYL = digitalio.DigitalInOut(board.MISO)
-    LED_START = digitalio.DigitalInOut(board.SDA)
-    LED_READY = digitalio.DigitalInOut(board.TX)
-    
-    #Constructor
-    def __init__(self):
-        #Configure pin objects
-        #ESTOP
-        self.ESTOP.direction = digitalio.Direction.INPUT
-        self.ESTOP.pull = digitalio.Pull.DOWN
-        
-        #KEYCYL
-        self.KEYCYL.direction = digitalio.Direction.INPUT
-        self.KEYCYL.pull = digitalio.Pull.DOWN
-        
-        #LED_START
-        self.LED_START.direction = digitalio.Direction.OUTPUT
-        
-        #LED_READY
-        self.LED_READY.direction = digitalio.Direction.OUTPUT
-        
-        #Set initial LED states. Off if DISABLE_LEDS or FLASHING_LEDS_ONLY is true, On if false
-        self.LED_START.value = not (DISABLE_LEDS or FLASHING_LEDS_ONLY)
-        self.LED_READY.value = not (DISABLE_LEDS or FLASHING_LEDS_ONLY)
-        
-    @staticmethod
-    def togglePin(pin):
-        if (DISABLE_LEDS):
-            #LEDs are disabled, always set state to false (off)
-            pin.value = False
-            
-        else:
-            #XOR current state to find it's complement
-            pin.value = pin.value ^ True
-       
-    @staticmethod
-    def setPin(pin, state):
-        if (DISABLE_LEDS or FLASHING_LEDS_ONLY):
-            #LEDs are disabled, always set state to false (off)
-            pin.value = False
-            
-        else:
-            pin.value = state
-        
-    #String override
-    def __str__(self):
-        return ("ESTOP: " + str(self.ESTOP.value) + "\n"
-                + "KEYCYL: " + str(self.KEYCYL.value) + "\n"
-                + "LED_START: " + str(self.LED_START.value) + "\n"
-                + "LED_READY: " + str(self.LED_READY.value))
+#Scan the E-Stop and key cylinder in the background. keypad debounces them and queues every change
+#as an event. The switches pull their input high while closed, so pressed means closed and
+#value_when_pressed=True makes pull=True enable the pull-downs the wiring needs
+INPUTS = keypad.Keys((board.RX, board.MISO), value_when_pressed=True, pull=True,
+                     interval=DEBOUNCE / 1000)
+ESTOP = const(0) #Key number in INPUTS
+KEYCYL = const(1) #Key number in INPUTS
+#Python never reads these pins itself, keypad scans them in C and only hands over changes
+
+#Set pin objects to simple names
+LED_START = digitalio.DigitalInOut(board.SDA)
+
+#Configure pin objects
+#LED_START
+LED_START.direction = digitalio.Direction.OUTPUT
+
+#Set initial LED states. Off if DISABLE_LEDS or FLASHING_LEDS_ONLY is true, On if false
+LED_START.value = not (DISABLE_LEDS or FLASHING_LEDS_ONLY)
+
+#LED_READY is blinked by a PIO state machine so the CPU never has to wake up to toggle it. It is
+#started when the E-Stop is triggered and stopped when it is released
+#Each half period is 2 set instructions plus 32 passes of an outer loop. Each outer pass is a
+#set, 32 passes through a 32 cycle delay loop, and a jmp: 1026 cycles
+#The first half flips the LED away from its idle state, so it visibly toggles as soon as the
+#state machine is restarted. Off first if the LED is lit steadily, on first if it is not
+READY_IDLE_LIT = not (DISABLE_LEDS or FLASHING_LEDS_ONLY)
+READY_BLINK = adafruit_pioasm.assemble("""
+.wrap_target
+    set pins, {first}
+    set y, 31
+first_half:
+    set x, 31
+first_delay:
+    jmp x-- first_delay [31]
+    jmp y-- first_half
+    set pins, {second}
+    set y, 31
+second_half:
+    set x, 31
+second_delay:
+    jmp x-- second_delay [31]
+    jmp y-- second_half
+.wrap
+""".format(first=0 if READY_IDLE_LIT else 1, second=1 if READY_IDLE_LIT else 0))
+READY_BLINK_CYCLES = const(32834) #PIO cycles per half period of READY_BLINK
+
+#The PIO clock divider can only slow the state machine down to about 1907 Hz and the clock can't
+#go past 125 MHz, which limits FLASHTIME to about 1 to 17000 ms
+if (not (1 <= FLASHTIME <= 17000)):
+    raise ValueError("FLASHTIME must be between 1 and 17000 milliseconds")
+
+#Instruction run on the stopped state machine to leave the ready LED in its idle state
+#On if lit steadily, off if DISABLE_LEDS or FLASHING_LEDS_ONLY is true
+READY_IDLE = adafruit_pioasm.assemble("set pins, 1" if READY_IDLE_LIT else "set pins, 0")
+
+LED_READY = rp2pio.StateMachine(READY_BLINK,
+                                frequency=READY_BLINK_CYCLES * 1000 // FLASHTIME,
+                                first_set_pin=board.TX,
+                                initial_set_pin_direction=1) #Output
+
+#The state machine starts running when created. Stop it and set the initial LED state
+LED_READY.stop()
+LED_READY.run(READY_IDLE)
 
 
 ##################################################################################################
@@ -137,135 +160,226 @@ class Pins():
 ##################################################################################################
     
 class State():
-    active = False
-    keyDown = False
-    
-    timeActivated = -100 #Seconds since boot
-    timeLastFlashed = -100 #Seconds since boot
-    timeLastKeypress = -100 #Seconds since boot
-    
+    #Constructor
+    #Every field is assigned here, always in the same order, so they are all instance attributes
+    #and reads never fall back to the class
+    def __init__(self):
+        self.active = False
+        self.keyDown = False
+        
+        #Switches start open (triggered), the same as keypad assumes before its first scan
+        self.estopClosed = False #True when the E-Stop is up, not triggered
+        self.keycylClosed = False #True when the key cylinder is unlocked, not triggered
+        
+        self.timeActivated = 0 #ticks_ms() milliseconds, compare with ticks_diff()
+        self.timeLastKeypress = 0 #ticks_ms() milliseconds, compare with ticks_diff()
+        self.nextReleaseDeadline = 0 #ticks_ms() milliseconds, when to release the current keypress
+        self.nextKeyDeadline = 0 #ticks_ms() milliseconds, when to send the next keypress
+        
     #String override
     def __str__(self):
-        return ("active: " + str(self.active) + "\n"
-                + "keyDown: " + str(self.keyDown) + "\n"
-                + "timeActivated: " + str(self.timeActivated) + "\n"
-                + "timeLastFlashed: " + str(self.timeLastFlashed) + "\n"
-                + "timeLastKeypress: " + str(self.timeLastKeypress))
+        #One f-string builds the result in one go, no intermediate strings to garbage collect
+        return (f"active: {self.active}\n"
+                f"keyDown: {self.keyDown}\n"
+                f"estopClosed: {self.estopClosed}\n"
+                f"keycylClosed: {self.keycylClosed}\n"
+                f"timeActivated: {self.timeActivated}\n"
+                f"timeLastKeypress: {self.timeLastKeypress}\n"
+                f"nextReleaseDeadline: {self.nextReleaseDeadline}\n"
+                f"nextKeyDeadline: {self.nextKeyDeadline}")
 
 
 ##################################################################################################
 # Init
 ##################################################################################################
 
-#Init Pin IO
-pins = Pins()
+#Resolve the LED settings once, they never change at runtime
+#STEADY_LEDS is the value to write to light a steady LED
+STEADY_LEDS = not (DISABLE_LEDS or FLASHING_LEDS_ONLY)
 
 #Spawn Keyboard object
 keyboard = Keyboard(usb_hid.devices)
 
+#Bind the keyboard methods once so each keypress skips the attribute lookup
+pressKey = keyboard.press
+releaseKeys = keyboard.release_all
+
 #Spawn State object
 state = State()
 
+#Spawn task events. triggered is set while the E-Stop is triggered, released is set while it isn't
+triggered = asyncio.Event()
+released = asyncio.Event()
+released.set()
+
+
+##################################################################################################
+# Main tasks
+##################################################################################################
 
 ##################################################################################################
-# Main loop
+# main()
+#
+# Entry point. Runs the input and keypress tasks cooperatively
+#
+# Never returns
 ##################################################################################################
+async def main():
+    await asyncio.gather(inputTask(), keyTask())
 
-def main():
+##################################################################################################
+# inputTask()
+#
+# Takes E-Stop changes from the keypad scanner and handles transitions between the triggered and
+#   untriggered states
+#   The keypress task is woken or parked through the triggered and released events, so it sleeps
+#   instead of polling while there is nothing to do. The ready LED blinker is started or stopped
+#
+# Compiled with the native code emitter since it runs every DEBOUNCE milliseconds. Viper can't be
+#   used, the loop handles keypad events and other Python objects
+#
+# Never returns
+##################################################################################################
+@micropython.native
+async def inputTask():
+    #Bind everything used every iteration to locals. Local lookups are much cheaper than global
+    #lookups and attribute chains on CircuitPython
+    s = state
+    ticks = ticks_ms
+    sleep = asyncio.sleep_ms
+    debug = DEBUG
+    events = INPUTS.events
+    event = keypad.Event() #Reused for every event so reading the queue doesn't allocate
+    ignoreKeycyl = DISABLE_KEYCYL
+    
+    #keypad assumes every switch starts open and only reports the closed ones on its first scan.
+    #Give it that scan before acting so the first pass sees the real switch positions instead of
+    #a false trigger. A switch that opens in the meantime is never missed, it just reports nothing
+    await sleep(2 * DEBOUNCE)
+    
     while True: #loop forever
-        dbg_printIOState()
+        #Record every queued input change. Pressed means closed, which is not triggered
+        while (events.get_into(event)):
+            if (event.key_number == ESTOP):
+                s.estopClosed = event.pressed
+                
+            else:
+                s.keycylClosed = event.pressed
+                
+        #If DISABLE_KEYCYL is true, only the button counts, the key cylinder is ignored
+        isTriggered = not (s.estopClosed and (ignoreKeycyl or s.keycylClosed))
+        if (debug): dbg_printIOState(ticks())
         
         #Check if the E-Stop is active
-        if (checkStops()):
+        if (isTriggered):
             #Is triggered
             
             #Were we already active?
-            if (state.active):
-                #We were already active
+            if (not s.active):
+                #We were not active, handle state transition
+                s.active = True
+                s.timeActivated = ticks()
                 
-                #Is the escape key down/pressed?
-                if (state.keyDown):
-                    #Key is down
-                    #Is it time to release the key?
-                    if ((time.monotonic() - state.timeLastKeypress >= DWELL)):
-                        #DWELL time has been exceeded, time to release
-                        releaseKeyPress()
-                    
-                else:
-                    #Key is up/unpressed
-                    #Has it been longer than 5 seconds since the last sent keypress?
-                    if ((time.monotonic() - state.timeLastKeypress) >= DELAY):
-                        #It has been longer, send a keypress
-                        sendKeyPress()
+                #Wake the keypress task
+                released.clear()
+                triggered.set()
                 
-                #Blink the start LED rapidly
-                if ((time.monotonic() - state.timeLastFlashed) >= FLASHTIME):
-                    #It has been longer than half the period of the given frequency, time to toggle
-                    pins.togglePin(pins.LED_READY)
-                    state.timeLastFlashed = time.monotonic()
+                #Start blinking the ready LED, unless LEDs are disabled
+                if (not DISABLE_LEDS):
+                    LED_READY.restart()
                 
-            else:
-                #We were not active, handle state transition
-                state.active = True
-                state.timeActivated = time.monotonic()
-                state.timeLastKeypress = -100 #Reset this timer on state entry to guarantee rapid
-                                               #keypress on E-Stop hit if the E-Stop was very
-                                               #recently deactivated
+            #else: do nothing since the keypress task and blinker handle the active state
                 
         else:
             #Is not triggered
             
             #Were we already inactive?
-            if (state.active):
+            if (s.active):
                 #We were active, handle state transition
-                state.active = False
-                pins.setPin(pins.LED_READY, True) #Turn on the ready LED
-                pins.setPin(pins.LED_START, False) #Make sure the start LED is off
+                s.active = False
+                
+                #Park the keypress task
+                triggered.clear()
+                released.set()
+                
+                #Stop blinking and turn on the ready LED
+                LED_READY.stop()
+                LED_READY.run(READY_IDLE)
+                LED_START.value = False #Make sure the start LED is off
                 releaseKeyPress() #Handle edge case where transition occurs during dwell time
                 
             #else: do nothing since we were already inactive
-                
-        time.sleep(0.01) #Wait 0.01 seconds before looping to allow inputs to debounce
-
+        
+        #Sleep until the keypad scanner reports an input change. It only adds events once per
+        #DEBOUNCE scan, so checking more often than that would just burn CPU time
+        while (not events):
+            await sleep(DEBOUNCE)
 
 ##################################################################################################
-# Function definitions
+# keyTask()
+#
+# Sends a keypress every DELAY milliseconds while the E-Stop is triggered. Sleeps while it is not
+#
+# Never returns
 ##################################################################################################
+async def keyTask():
+    while True: #loop forever
+        #Sleep until the E-Stop is triggered
+        await triggered.wait()
+        
+        #Press the key and hold it until the release deadline
+        #Both deadlines are set from the press time, so time spent sending reports doesn't drift the
+        #keypress cadence
+        sendKeyPress(ticks_ms())
+        
+        #Cut the dwell short if the E-Stop is released. The input task has already released the
+        #key, so go straight back to waiting for the next E-Stop hit
+        try:
+            await asyncio.wait_for_ms(released.wait(),
+                                      ticks_diff(state.nextReleaseDeadline, ticks_ms()))
+            continue
+            
+        except asyncio.TimeoutError:
+            pass #Still triggered, the dwell is over
+            
+        if (state.keyDown):
+            releaseKeyPress()
+        
+        #Wait until the next keypress deadline. Cut the wait short if the E-Stop is released, this
+        #guarantees a rapid keypress on the next E-Stop hit even if it happens very soon after
+        try:
+            await asyncio.wait_for_ms(released.wait(),
+                                      ticks_diff(state.nextKeyDeadline, ticks_ms()))
+            
+        except asyncio.TimeoutError:
+            pass #Still triggered, loop around to send the next keypress
+
 
 ##################################################################################################
-# checkStops()
-#
-# Checks if the E-Stop has been triggered either through the big red button or the lock cylinder
-#   If DISABLE_KEYCYL is true, only the button will be checked, the key cylinder will be ignored
-#
-# Returns true if the E-Stop has been triggered, false if not
+# Function definitions
 ##################################################################################################
-def checkStops():
-    #Check if the button is down or the cylinder is locked
-    #Input signals are backwards from what you would think. A true input is not triggered
-    if pins.ESTOP.value and (pins.KEYCYL.value or DISABLE_KEYCYL):
-        return False #Return not triggered
-    
-    else:
-        return True #Return triggered
 
 ##################################################################################################
 # sendKeyPress()
 #
 # Sends the escape keypress (or another key if KEYCODE has been changed in the constants section)
 # Turns off the start LED
-# Records when the key was pressed, sets the keyDown state
+# Records when the key was pressed and schedules the release and next keypress deadlines, sets the
+#   keyDown state
+#   now is the current ticks_ms() reading, passed in so the caller's clock read is reused
 #
 # Returns void
 ##################################################################################################
-def sendKeyPress():
+def sendKeyPress(now):
     #Press the key, turn off the start LED
-    keyboard.press(KEYCODE)
-    pins.setPin(pins.LED_START, False)
+    pressKey(KEYCODE)
+    LED_START.value = False
     
     #Update state record
     state.keyDown = True
-    state.timeLastKeypress = time.monotonic()
+    state.timeLastKeypress = now
+    state.nextReleaseDeadline = ticks_add(now, DWELL)
+    state.nextKeyDeadline = ticks_add(now, DELAY)
 
 ##################################################################################################
 # releaseKeyPress()
@@ -276,26 +390,28 @@ def sendKeyPress():
 ##################################################################################################
 def releaseKeyPress(): 
     #Release the key, update state record, relight the start LED
-    keyboard.release_all()
+    releaseKeys()
     state.keyDown = False
-    pins.setPin(pins.LED_START, True)
+    LED_START.value = STEADY_LEDS
 
 ##################################################################################################
 # dbg_printIOState()
 #
 # Prints the current position of all inputs and state of all outputs to shell
+#   The ready LED is left out, the blinker can't be read back. It blinks while active is true
 #
-# Runs only if DEBUG is true
+# Only called if DEBUG is true, callers check it so release builds skip the call entirely
+#   Called whenever an input changes
+#   now is the current ticks_ms() reading, passed in so the caller's clock read is reused
 #
 # Returns void
 ##################################################################################################
-def dbg_printIOState():
-    #Run only in debug mode
-    if not DEBUG: return
-    
+def dbg_printIOState(now):
     #Print every pin's state and all other state variables
-    print(str(time.monotonic()) + "\n" + str(pins) + "\n" + str(state) + "\n")
+    print(f"{now}\n"
+          f"LED_START: {LED_START.value}\n"
+          f"{state}\n")
 
 
 #Call entry point
-main()
\ No newline at end of file
+asyncio.run(main())
\ No newline at end of file